@@ -2,25 +2,28 @@
 
 from __future__ import annotations
 
+import re
 import os
 import sys
 import enum
-import json
 import time
 import shlex
 import shutil
+import socket
 import logging
 import paramiko
+import posixpath
+import tempfile
 import threading
 import traceback
 import subprocess
+import collections
 import ffmpeg_parser
-from io import StringIO
-from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 from serde import deserialize, field
 from serde.json import from_json, to_json
 from dataclasses import dataclass, fields
-from typing import Optional, Dict, List, Tuple, Callable
+from typing import Optional, Dict, List, Set, Tuple, Callable, Deque, Iterator
 
 
 class LogLevel(enum.Enum):
@@ -43,7 +46,42 @@ class DistrFFmpegError(Exception):
     pass
 
 
-@dataclass
+# dirty: slots in dataclasses are only supported since python 3.10
+# plain dataclasses are used on older versions
+DATACLASS_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+
+# seconds a failed job waits before it's dispatched again
+JOB_RETRY_DELAY = 5.0
+
+
+# weight of the latest finished job in worker's average speed
+FRAME_SECONDS_SMOOTHING = 0.3
+
+
+# ciphers and macs tried first when connecting to workers
+# aes-gcm has authentication built in and uses hardware acceleration on most cpus
+# but only recent paramiko releases implement it, older ones fall back to aes128-ctr
+# the negotiated cipher is logged on connect so the fallback is visible
+FAST_CIPHERS = ('aes128-gcm@openssh.com', 'aes128-ctr')
+FAST_DIGESTS = ('hmac-sha2-256',)
+
+
+def prefer_algorithms(available: Tuple[str, ...], preferred: Tuple[str, ...]) -> Tuple[str, ...]:
+    return (
+        tuple(a for a in preferred if a in available) +
+        tuple(a for a in available if a not in preferred)
+    )
+
+
+# local compress command and remote decompress command for tar uploads to Linux workers
+COMPRESSORS: Dict[str, Tuple[List[str], str]] = {
+    'zstd': (['zstd', '-T0', '-1', '-c'], 'zstd -d -c'),
+    'pigz': (['pigz', '-c'], 'pigz -d -c'),
+}
+
+
+@dataclass(**DATACLASS_SLOTS)
 class CommandResult:
 
     stdout: bytes
@@ -51,16 +89,20 @@ class CommandResult:
     exit_code: int
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class Job:
 
     ffmpeg_cmds: List[ffmpeg_parser.FFmpegCommand]
     segments_dir: str
     required_segments: List[str]
     output_fpath: str
-    taken: bool = False
+    frames: int = 0
     completed: bool = False
     retries: int = -1
+    # failed jobs aren't dispatched again before this time
+    not_before: float = 0.0
+    # worker that failed the job last, it only gets the job back when no other worker is connected
+    failed_on: Optional[Worker] = None
 
 
 @deserialize
@@ -73,22 +115,52 @@ class Worker:
     ffmpeg_bin: str
     params: Dict[str, str]
     platform: str = 'Linux'  # dirty: maybe make a separate type for it
+    upload_threads: int = 8
+    # segments are already compressed video so uploads are not compressed by default
+    # only applies to Linux workers, see COMPRESSORS for available values
+    compress: Optional[str] = None
+    socket_buffer_size: int = 32 * 1024 * 1024
 
-    free: bool = True
     ssh: Optional[paramiko.client.SSHClient] = None
     sftp: Optional[paramiko.sftp_client.SFTPClient] = None
     connected: bool = False
 
+    # segments are uploaded in parallel, every upload thread
+    # gets its own sftp session opened on the same ssh transport
+    upload_executor: Optional[ThreadPoolExecutor] = None
+    upload_sftp_local: Optional[threading.local] = None
+    upload_sftp_sessions: Optional[List[paramiko.sftp_client.SFTPClient]] = None
+
     jobs_completed: int = 0
+    jobs_failed: int = 0
     exec_command: Optional[Callable] = None
 
+    # speed of the worker as moving average of seconds spent per frame of finished jobs
+    frame_seconds: Optional[float] = None
+    # start time and length of the currently running job
+    job_started_at: Optional[float] = None
+    job_frames: int = 0
+
+    # directory inside work_path owned by this connection, every job works in its subdirectory
+    worker_root: Optional[str] = None
+    # (filename, size, mtime) of local segment files already present in worker_root/segments
+    uploaded_segments: Optional[Set[Tuple[str, int, float]]] = None
+
     def connect(self) -> None:
 
+        # checked before anything is created on the worker
+        if self.platform not in ('Linux', 'Windows'):
+            raise DistrFFmpegError("Worker platform has to be either Linux or Windows.")
+
         self.ssh = paramiko.SSHClient()
         self.ssh.load_system_host_keys()
 
         try:
-            self.ssh.connect(self.host, username=self.user, **self.params)
+            sock = self.open_socket()
+            self.ssh.connect(
+                self.host, username=self.user, sock=sock,
+                transport_factory=self.create_transport, **self.params
+            )
         except:
             # if unable to connect to worker via ssh
             # just set connected to False
@@ -96,28 +168,139 @@ class Worker:
             self.connected = False
             return
 
-        self.sftp = self.ssh.open_sftp()
+        # channels opened from now on (sftp sessions, commands) advertise
+        # a larger receive window and packet size than paramiko's defaults
+        transport = self.ssh.get_transport()
+        logger.log(
+            LogLevel.DEBUG.value,
+            f'Negotiated {transport.local_cipher} / {transport.local_mac or "aead"} with {self.user}@{self.host}'
+        )
+        transport.default_window_size = 4 * 1024 * 1024
+        transport.default_max_packet_size = 256 * 1024
+
+        # worker only counts as connected once its root exists
+        # so that disconnect() always has a root to clean up
+        try:
+            self.sftp = self.ssh.open_sftp()
+            self.worker_root = posixpath.join(self.work_path, os.urandom(8).hex())
+            self.sftp_makedirs(self.worker_root)
+            self.sftp.mkdir(posixpath.join(self.worker_root, "segments"))
+        except Exception as e:
+            logger.log(
+                LogLevel.WARNING.value,
+                f'Failed to create work directory on worker {self.user}@{self.host}: {e}'
+            )
+            if self.sftp is not None:
+                # root may already exist when only creating segments directory failed
+                try:
+                    self.sftp.rmdir(self.worker_root)
+                except IOError:
+                    pass
+                self.sftp.close()
+            self.ssh.close()
+            self.sftp = None
+            self.ssh = None
+            self.worker_root = None
+            self.connected = False
+            return
+
+        self.uploaded_segments = set()
         self.connected = True
-        
-        if self.platform not in ('Linux', 'Windows'):
-            return DistrFFmpegError("Worker platform has to be either Linux or Windows.")
+
+        self.upload_executor = ThreadPoolExecutor(max_workers=self.upload_threads)
+        self.upload_sftp_local = threading.local()
+        self.upload_sftp_sessions = []
         self.exec_command = self.exec_command_linux if self.platform == 'Linux' else self.exec_command_windows
 
+    # paramiko would otherwise connect through a socket with default kernel buffers
+    # and Nagle's algorithm enabled which throttles transfers on high-latency links
+    def open_socket(self) -> socket.socket:
+
+        port = int(self.params.get('port', 22))
+
+        # like paramiko, try every resolved address since the first one
+        # (often IPv6 for localhost or .local hosts) doesn't have to be reachable
+        last_error: Optional[OSError] = None
+        for family, socktype, proto, _, addr in socket.getaddrinfo(self.host, port, 0, socket.SOCK_STREAM):
+
+            sock = socket.socket(family, socktype, proto)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # buffers have to be set before connecting so tcp window scaling can use them
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer_size)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_buffer_size)
+            sock.settimeout(self.params.get('timeout'))
+
+            try:
+                sock.connect(addr)
+            except OSError as e:
+                sock.close()
+                last_error = e
+                continue
+            except:
+                sock.close()
+                raise
+
+            return sock
+
+        if last_error is None:
+            last_error = OSError(f"No addresses found for {self.host}.")
+        raise last_error
+
+    def create_transport(self, sock: socket.socket, **kwargs) -> paramiko.Transport:
+
+        transport = paramiko.Transport(sock, **kwargs)
+
+        options = transport.get_security_options()
+        options.ciphers = prefer_algorithms(options.ciphers, FAST_CIPHERS)
+        options.digests = prefer_algorithms(options.digests, FAST_DIGESTS)
+
+        return transport
+
     def disconnect(self) -> None:
+        self.upload_executor.shutdown(wait=True)
+        self.exec_command(
+            ('rm -rf' if self.platform == 'Linux' else 'rm -r -force') + f' "{self.worker_root}"'
+        )
+        self.worker_root = None
+        self.uploaded_segments = None
+        for sftp in self.upload_sftp_sessions:
+            sftp.close()
+        self.upload_executor = None
+        self.upload_sftp_local = None
+        self.upload_sftp_sessions = None
         self.sftp.close()
         self.ssh.close()
         self.sftp = None
         self.ssh = None
         self.connected = False
 
+    # sftp can only create one directory at a time, so missing parents are created first
+    def sftp_makedirs(self, path: str) -> None:
+
+        try:
+            self.sftp.stat(path)
+            return
+        except IOError:
+            pass
+
+        parent = posixpath.dirname(path)
+        if parent and parent != path:
+            self.sftp_makedirs(parent)
+
+        self.sftp.mkdir(path)
+
     def exec_command_linux(self, cmd: str) -> CommandResult:
         assert self.connected
         logger.log(LogLevel.SHELL.value, f"Running remote Linux command: {cmd}")
 
-        stdin, stdout, stderr = self.ssh.exec_command(cmd, get_pty=True)
-        exit_code = stdout.channel.recv_exit_status()
+        # no pty is allocated, stderr is merged into stdout the same way a pty would do it
+        # output is read before waiting for exit so that the channel window never fills up
+        stdin, stdout, stderr = self.ssh.exec_command(cmd)
+        stdout.channel.set_combine_stderr(True)
         stdin.close()
-        return CommandResult(stdout.read(), stderr.read(), exit_code)
+        output = stdout.read()
+        exit_code = stdout.channel.recv_exit_status()
+        return CommandResult(output, stderr.read(), exit_code)
 
     # on windows command is executed via powershell
     # the client is required to have powershell installed
@@ -143,11 +326,85 @@ class Worker:
         
         return CommandResult(stdout.read(), stderr.read(), exit_code)
 
+    # called from upload threads only
+    def get_upload_sftp(self) -> paramiko.sftp_client.SFTPClient:
+        sftp = getattr(self.upload_sftp_local, 'sftp', None)
+        if sftp is None:
+            sftp = self.ssh.open_sftp()
+            self.upload_sftp_local.sftp = sftp
+            self.upload_sftp_sessions.append(sftp)
+        return sftp
+
+    # same as sftp.put(confirm=False) which skips the extra stat round-trip
+    # but reads the local file in bigger blocks and keeps writes pipelined
+    # so they are not waiting for server acks one by one
+    def upload_file(self, local_fpath: str, remote_fpath: str) -> None:
+
+        sftp = self.get_upload_sftp()
+
+        with open(local_fpath, 'rb') as fl, sftp.open(remote_fpath, 'wb') as fr:
+            fr.set_pipelined(True)
+            while True:
+                buf = fl.read(256 * 1024)
+                if not buf:
+                    break
+                fr.write(buf)
+
+    # uploads all the files into remote_dir keeping their base names
+    # on linux workers they are streamed through a single tar pipe over ssh
+    # instead of paying sftp round-trips for every file
+    def bulk_upload(self, fpaths: List[str], remote_dir: str) -> None:
+
+        # dirty: windows workers fall back to parallel sftp uploads
+        if self.platform != 'Linux':
+            uploads = [
+                self.upload_executor.submit(
+                    self.upload_file, fpath, posixpath.join(remote_dir, os.path.basename(fpath))
+                ) for fpath in fpaths
+            ]
+            # wait for all files and propagate the first failed upload
+            for upload in uploads:
+                upload.result()
+            return
+
+        tar_cmd = ['tar', '-cf', '-']
+        for fpath in fpaths:
+            tar_cmd += ['-C', os.path.dirname(os.path.abspath(fpath)), os.path.basename(fpath)]
+
+        remote_cmd = f'tar -xf - -C "{remote_dir}"'
+
+        logger.log(LogLevel.SHELL.value, f"Streaming local command to worker: {shlex.join(tar_cmd)}")
+        procs = [subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)]
+
+        # the tarball can be piped through a multithreaded compressor on both sides
+        if self.compress is not None:
+            compress_cmd, decompress_cmd = COMPRESSORS[self.compress]
+            logger.log(LogLevel.SHELL.value, f"Compressing upload with: {shlex.join(compress_cmd)}")
+            procs.append(subprocess.Popen(compress_cmd, stdin=procs[-1].stdout, stdout=subprocess.PIPE))
+            # compressor owns the pipe now, tar gets SIGPIPE if it exits early
+            procs[0].stdout.close()
+            remote_cmd = f'{decompress_cmd} | {remote_cmd}'
+
+        try:
+            stdin, stdout, stderr = self.ssh.exec_command(remote_cmd)
+            while True:
+                buf = procs[-1].stdout.read(1024 * 1024)
+                if not buf:
+                    break
+                stdin.write(buf)
+            stdin.channel.shutdown_write()
+            exit_code = stdout.channel.recv_exit_status()
+        finally:
+            # closing the pipe stops local processes if the remote side went away
+            procs[-1].stdout.close()
+            for proc in procs:
+                proc.wait()
+
+        if any(proc.returncode != 0 for proc in procs) or exit_code != 0:
+            raise DistrFFmpegError("Uploading files to worker failed.")
+
     def add_job(self, job: Job) -> None:
 
-        self.free = False
-        job.taken = True
-        
         job.retries += 1
 
         try:
@@ -156,46 +413,74 @@ class Worker:
             # job failed
             # TODO: print verbose info about failed job
             traceback.print_exc()
-            self.free = True
-            job.taken = False
+            self.jobs_failed += 1
             return
 
+        frame_seconds = (time.time() - self.job_started_at) / max(job.frames, 1)
+        if self.frame_seconds is None:
+            self.frame_seconds = frame_seconds
+        else:
+            self.frame_seconds += FRAME_SECONDS_SMOOTHING * (frame_seconds - self.frame_seconds)
+
         job.completed = True
-        self.free = True
 
         self.jobs_completed += 1
 
+    # expected time at which this worker would finish a job with given number of frames
+    # if it got the job right after the current one, None if the worker's speed is unknown yet
+    def estimate_finish(self, frames: int, now: float) -> Optional[float]:
 
-    def _add_job_supervised(self, job: Job) -> None:
+        if self.frame_seconds is None:
+            return None
 
-        self.job_work_path = os.path.join(
-            self.work_path, os.urandom(8).hex()
-        )
+        busy_until = now
+        if self.job_started_at is not None:
+            busy_until = max(now, self.job_started_at + self.frame_seconds * self.job_frames)
 
-        res = self.exec_command(f'mkdir -p "{self.job_work_path}"')
-        assert res.exit_code == 0
+        return busy_until + self.frame_seconds * frames
 
-        sio = StringIO()
-        for seg in job.required_segments:
-            self.sftp.put(os.path.join(job.segments_dir, seg.filename), os.path.join(self.job_work_path, seg.filename))
-            sio.write(f"file '{seg.filename}'\n")
 
-        self.sftp.put(os.path.join(job.segments_dir, "segments.csv"), os.path.join(self.job_work_path, "segments.csv"))
-        sio.seek(0)
-        self.sftp.putfo(sio, os.path.join(self.job_work_path, "segments.txt"))
-        sio.close()
+    def _add_job_supervised(self, job: Job) -> None:
 
-        shell_cmd = '; '.join([self.ffmpeg_bin + " " + cmd.get_command(without_bin=True) for cmd in job.ffmpeg_cmds])
-        res = self.exec_command(f'cd "{self.job_work_path}"; {shell_cmd}')
+        self.job_work_path = posixpath.join(
+            self.worker_root, os.urandom(8).hex()
+        )
+
+        self.sftp.mkdir(self.job_work_path)
+
+        # neighbouring jobs share segments, so every segment is uploaded to the worker only once
+        # and jobs read them from the common segments directory
+        upload_fpaths = []
+        upload_keys = []
+        for filename in [seg.filename for seg in job.required_segments] + ["segments.csv"]:
+            fpath = os.path.join(job.segments_dir, filename)
+            st = os.stat(fpath)
+            key = (filename, st.st_size, st.st_mtime)
+            if key not in self.uploaded_segments:
+                upload_fpaths.append(fpath)
+                upload_keys.append(key)
+
+        if upload_fpaths:
+            self.bulk_upload(upload_fpaths, posixpath.join(self.worker_root, "segments"))
+            self.uploaded_segments.update(upload_keys)
+
+        # concat list is small, it's built in memory and sent with a single write
+        segments_list = ''.join(f"file '../segments/{seg.filename}'\n" for seg in job.required_segments).encode('utf-8')
+        with self.sftp.open(posixpath.join(self.job_work_path, "segments.txt"), 'wb') as f:
+            f.set_pipelined(True)
+            f.write(segments_list)
+
+        # powershell on windows workers has no '&&' operator
+        cmd_sep = ' && ' if self.platform == 'Linux' else '; '
+        shell_cmd = cmd_sep.join([self.ffmpeg_bin + " " + cmd.get_command(without_bin=True) for cmd in job.ffmpeg_cmds])
+        res = self.exec_command(f'cd "{self.job_work_path}"{cmd_sep}{shell_cmd}')
         logger.log(LogLevel.SHELL.value, f'Executed shell command: {shell_cmd}')
         # TODO: also show output of commands in log
         #logger.debug(res.stdout.decode("utf-8"), res.stderr.decode("utf-8"))
         assert res.exit_code == 0
         
-        self.sftp.get(os.path.join(self.job_work_path, "out.mkv"), job.output_fpath)
-        self.exec_command(
-            ('rm -rf' if self.platform == 'Linux' else 'rm -r -force') + f' "{self.job_work_path}"'
-        )
+        # job directory is removed together with worker_root on disconnect
+        self.sftp.get(posixpath.join(self.job_work_path, "out.mkv"), job.output_fpath)
 
 
 @deserialize
@@ -220,22 +505,41 @@ class Config:
             self.keyint_min > 0 and
             self.keyint_max >= self.keyint_min and
             self.job_max_retries > 0 and
-            self.workers != []
+            self.workers != [] and
+            all(w.platform in ('Linux', 'Windows') for w in self.workers) and
+            all(w.compress is None or w.compress in COMPRESSORS for w in self.workers)
         )
 
         return is_valid
 
 
-@dataclass
+# every frame is printed by ffmpeg's metadata filter as:
+# frame:0    pts:0       pts_time:0
+# lavfi.scene_score=0.000000
+# timestamps can also be NOPTS or printed with an exponent like 1e-05
+SCENE_SCORE_RE = re.compile(
+    rb'frame:(\d+)\s+pts:(\S+)\s+pts_time:(\S+)\s+lavfi\.scene_score=(\S+)'
+)
+
+
+def parse_timestamp(val: bytes) -> Optional[float]:
+    if val == b'NOPTS':
+        return None
+    if b'.' in val or b'e' in val:
+        return float(val)
+    return int(val)
+
+
+@dataclass(**DATACLASS_SLOTS)
 class SceneScore:
 
     frame: Optional[int] = None
     pts: Optional[int] = None
-    pts_time: Optional[Decimal] = None
+    pts_time: Optional[float] = None
     score: Optional[float] = None
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class Segment:
 
     idx: Optional[int] = None
@@ -254,6 +558,13 @@ class DistrFFmpeg(object):
     jobs: List[Job]
     user_cmd: str
 
+    # scheduler state shared with job threads, guarded by sched_cv
+    # job threads notify it whenever a worker becomes free again
+    waiting_jobs: Deque[Job]
+    free_workers: Deque[Worker]
+    completed_jobs_count: int
+    sched_cv: threading.Condition
+
     def __init__(self, config_path: str, raw_user_cmd: str) -> None:
 
         # read config file
@@ -277,6 +588,11 @@ class DistrFFmpeg(object):
         self.segments = []
         self.jobs = []
 
+        self.waiting_jobs = collections.deque()
+        self.free_workers = collections.deque()
+        self.completed_jobs_count = 0
+        self.sched_cv = threading.Condition()
+
         self.fetch_cur_work_path()
 
 
@@ -293,6 +609,34 @@ class DistrFFmpeg(object):
         return r
 
 
+    # yields stdout of the command line by line as it's being produced
+    # closing the generator early terminates the command
+    def stream_shell(self, cmd: str) -> Iterator[bytes]:
+
+        logger.log(LogLevel.SHELL.value, f"Streaming local command: {cmd}")
+
+        # stderr goes to a temporary file so the command can't block on a full pipe
+        # while stdout is being read, it's only logged when the command fails
+        with tempfile.TemporaryFile() as stderr:
+
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, shell=True)
+
+            try:
+                for line in p.stdout:
+                    yield line
+            except GeneratorExit:
+                p.terminate()
+                raise
+            finally:
+                p.stdout.close()
+                p.wait()
+
+            if p.returncode != 0:
+                stderr.seek(0)
+                logger.log(LogLevel.SHELL.value, f"Failed command stderr: {stderr.read().decode('utf-8', errors='replace')}")
+                raise DistrFFmpegError("Command finished with non-zero exit code")
+
+
     def get_ffmpeg_commands(self, base_cmd: str, scope: ffmpeg_parser.ArgScope) -> List[ffmpeg_parser.FFmpegCommand]:
 
         parser = ffmpeg_parser.Parser(scope)
@@ -316,51 +660,78 @@ class DistrFFmpeg(object):
 
         workers_cnt = 0
 
-        # connect to each worker
-        for worker in self.config.workers:
+        try:
 
-            worker.connect()
-            logger.log(
-                LogLevel.DEBUG.value,
-                f'Connection to {worker.user}@{worker.host} -> ' + ('ok' if worker.connected else 'failed')
-            )
+            # connect to each worker
+            for worker in self.config.workers:
 
-            if worker.connected:
-                workers_cnt += 1
+                worker.connect()
+                logger.log(
+                    LogLevel.DEBUG.value,
+                    f'Connection to {worker.user}@{worker.host} -> ' + ('ok' if worker.connected else 'failed')
+                )
 
-        if workers_cnt == 0:
-            raise DistrFFmpegError('No workers found online.')
+                if worker.connected:
+                    workers_cnt += 1
 
-        logger.log(LogLevel.QUIET.value, f'Starting distributed encoder with {workers_cnt} workers.')
+            if workers_cnt == 0:
+                raise DistrFFmpegError('No workers found online.')
 
-        start_time = time.time()
+            logger.log(LogLevel.QUIET.value, f'Starting distributed encoder with {workers_cnt} workers.')
 
-        # while not all jobs have completed state
-        while True:
+            start_time = time.time()
 
-            completed_jobs_count = [j.completed for j in self.jobs].count(True)
-            logger.log(LogLevel.INFO.value, f'Completed jobs: {completed_jobs_count} / {len(self.jobs)}')
+            with self.sched_cv:
 
-            if completed_jobs_count == len(self.jobs):
-                break
+                self.free_workers = collections.deque(w for w in self.config.workers if w.connected)
 
-            for worker in self.config.workers:
-                if worker.free and worker.connected:
-                    j = self.get_waiting_job()
-                    
-                    if not j:
-                        break
+                # while not all jobs have completed state
+                while self.completed_jobs_count < len(self.jobs):
+
+                    # nothing can be dispatched until some job thread finishes
+                    if not (self.free_workers and self.waiting_jobs):
+                        self.sched_cv.wait()
+                        continue
+
+                    job_idx, worker, wake_at = self.pick_next_dispatch()
+                    if worker is None:
+                        # without wake_at only a finishing job can change anything
+                        self.sched_cv.wait(
+                            timeout=None if wake_at is None else max(wake_at - time.time(), 0.0) + 0.01
+                        )
+                        continue
+
+                    j = self.get_waiting_job(job_idx)
 
                     if j.retries >= self.config.job_max_retries:
                         raise DistrFFmpegError("Exceeded number of retries for current job.")
 
-                    t = threading.Thread(target=worker.add_job, args=(j,))
+                    # set under the lock so pick_free_worker never sees the worker neither free nor busy
+                    worker.job_started_at = time.time()
+                    worker.job_frames = j.frames
+
+                    t = threading.Thread(target=self.run_job, args=(worker, j))
                     t.daemon = True
                     t.start()
 
-            time.sleep(5)
+            self.merge_final_slices()
+
+        finally:
+
+            # workers keep every segment and encoded slice under their root until disconnected
+            # so clean them up even when encoding fails or gets interrupted
+            for worker in self.config.workers:
+
+                if not worker.connected:
+                    continue
 
-        self.merge_final_slices()
+                try:
+                    worker.disconnect()
+                except Exception as e:
+                    logger.log(
+                        LogLevel.WARNING.value,
+                        f'Failed to clean up worker {worker.user}@{worker.host}: {e}'
+                    )
 
         time_taken_total = round(time.time() - pre_start_time, 2)
         time_taken = round(time.time() - start_time, 2)
@@ -387,7 +758,7 @@ class DistrFFmpeg(object):
         slices_metafile_path = os.path.join(slices_dir, "slices.txt")
 
         with open(slices_metafile_path, 'w', encoding='utf-8') as f:
-            for job in self.jobs:
+            for job in sorted(self.jobs, key=lambda j: j.output_fpath):
                 slice_fname = os.path.basename(job.output_fpath)
                 f.write(f"file '{slice_fname}'\n")
 
@@ -401,12 +772,129 @@ class DistrFFmpeg(object):
         shutil.rmtree(self.cur_work_path)
 
 
-    def get_waiting_job(self) -> Optional[Job]:
+    def get_waiting_job(self, idx: int = 0) -> Optional[Job]:
 
-        for job in self.jobs:
-            if not job.taken:
-                return job
-        return None
+        with self.sched_cv:
+            if len(self.waiting_jobs) <= idx:
+                return None
+            if idx == 0:
+                return self.waiting_jobs.popleft()
+            job = self.waiting_jobs[idx]
+            del self.waiting_jobs[idx]
+            return job
+
+
+    # finds the first waiting job that can be dispatched now and takes a free worker for it
+    # returns (job index, worker, None) to dispatch, or (None, None, wake_at) when nothing can be
+    # dispatched yet, wake_at being when to look again or None to wait for a job to finish
+    def pick_next_dispatch(self) -> Tuple[Optional[int], Optional[Worker], Optional[float]]:
+
+        with self.sched_cv:
+
+            now = time.time()
+            wake_at = None
+
+            for idx, job in enumerate(self.waiting_jobs):
+
+                # failed jobs wait out their retry delay while the rest keep being dispatched
+                if job.not_before > now:
+                    if wake_at is None or job.not_before < wake_at:
+                        wake_at = job.not_before
+                    continue
+
+                worker, recheck_at = self.pick_free_worker(job)
+                if worker is not None:
+                    return idx, worker, None
+
+                # busy workers will finish the remaining jobs sooner than any free one
+                # unless they run past their estimates, wake up just past the earliest estimate
+                if recheck_at is not None:
+                    if wake_at is None or recheck_at < wake_at:
+                        wake_at = recheck_at
+                    return None, None, wake_at
+
+                # only the worker that failed this job is free, try the next one
+
+            return None, None, wake_at
+
+
+    # takes the fastest free worker for the job out of free workers
+    # returns (worker, None) to run the job on that worker, (None, recheck_at) when it's better
+    # to leave the job for a faster busy worker, recheck_at being when to reconsider holding it,
+    # or (None, None) when the only free worker is the one that just failed the job
+    def pick_free_worker(self, job: Job) -> Tuple[Optional[Worker], Optional[float]]:
+
+        with self.sched_cv:
+
+            # a failed job goes to its last worker again only if there is no other one
+            excluded = job.failed_on
+            if excluded is not None and not any(
+                w.connected and w is not excluded for w in self.config.workers
+            ):
+                excluded = None
+
+            candidates = [i for i, w in enumerate(self.free_workers) if w is not excluded]
+            if not candidates:
+                return None, None
+
+            # workers that failed jobs go last, then workers with unknown speed go first
+            # so that their speed gets measured
+            idx = min(
+                candidates,
+                key=lambda i: (self.free_workers[i].jobs_failed, self.free_workers[i].frame_seconds or 0.0)
+            )
+            worker = self.free_workers[idx]
+
+            now = time.time()
+            finish = worker.estimate_finish(job.frames, now)
+
+            if finish is not None:
+
+                faster_busy_workers = 0
+                recheck_at = None
+                for w in self.config.workers:
+                    if not w.connected or w.job_started_at is None or w.frame_seconds is None:
+                        continue
+                    # a worker running past its estimate can't be counted on to finish soon
+                    w_busy_until = w.job_started_at + w.frame_seconds * w.job_frames
+                    if w_busy_until < now:
+                        continue
+                    if w.estimate_finish(job.frames, now) < finish:
+                        faster_busy_workers += 1
+                        if recheck_at is None or w_busy_until < recheck_at:
+                            recheck_at = w_busy_until
+
+                # only hold jobs at the end of encoding when every one of them
+                # has a busy worker that will get it done sooner
+                # once any of those overruns its estimate the job has to be reconsidered
+                if faster_busy_workers >= len(self.waiting_jobs):
+                    return None, recheck_at
+
+            del self.free_workers[idx]
+            return worker, None
+
+
+    # runs in a separate thread for every dispatched job
+    def run_job(self, worker: Worker, job: Job) -> None:
+
+        worker.add_job(job)
+
+        with self.sched_cv:
+            # cleared together with putting the worker back to free workers, see run()
+            worker.job_started_at = None
+
+            if job.completed:
+                self.completed_jobs_count += 1
+                logger.log(LogLevel.INFO.value, f'Completed jobs: {self.completed_jobs_count} / {len(self.jobs)}')
+            else:
+                # failed job goes back to the front of the queue to be retried first
+                # but only after a delay so that short network failures don't use up its retries
+                job.not_before = time.time() + JOB_RETRY_DELAY
+                job.failed_on = worker
+                self.waiting_jobs.appendleft(job)
+
+            self.free_workers.append(worker)
+            self.sched_cv.notify()
 
 
     def fetch_scenescores(self) -> None:
@@ -421,25 +909,21 @@ class DistrFFmpeg(object):
 
         shell_cmd = self.config.ffmpeg_bin + " " + ffcmds[0].get_command(without_bin=True)
         self.execute_shell(shell_cmd)
-        with open(scenescores_path, 'r', encoding='utf-8') as f:
-
-            while True:
-                cur_score = SceneScore()
-
-                frameinfo = f.readline().strip()
-                if frameinfo == '':
-                    break
-
-                for keyval in frameinfo.split(' '):
-                    if keyval == '':
-                        continue
-                    keyval = keyval.strip()
-                    key, val = keyval.split(':')
-                    setattr(cur_score, key, Decimal(val) if '.' in val else int(val))
+        with open(scenescores_path, 'rb') as f:
+            scenescores_data = f.read()
+
+        self.scene_scores = [
+            SceneScore(
+                frame=int(frame),
+                pts=parse_timestamp(pts),
+                pts_time=parse_timestamp(pts_time),
+                score=float(score)
+            ) for frame, pts, pts_time, score in SCENE_SCORE_RE.findall(scenescores_data)
+        ]
 
-                lavfi_ss = f.readline().strip()
-                cur_score.score = float(lavfi_ss.split('=')[1])
-                self.scene_scores.append(cur_score)
+        # jobs index scene scores by frame number so none of the frames can be skipped
+        if len(self.scene_scores) != scenescores_data.count(b'frame:'):
+            raise DistrFFmpegError("Failed to parse scene scores.")
 
 
     def fetch_segments(self) -> None:
@@ -462,20 +946,23 @@ class DistrFFmpeg(object):
         shell_cmd = self.config.ffmpeg_bin + " " + ffcmds[0].get_command(without_bin=True)
         self.execute_shell(shell_cmd)
         
-        # run ffprobe on every segment in order to get first keyframe index
-        for seg in self.segments:
+        # run ffprobe once over all segments joined together in order to get first keyframe index of each
+        # segment muxer splits exactly at given frame numbers so packet n belongs to segment at frame n
+        segments_concat_path = os.path.join(self.cur_work_path, 'segments_concat.txt')
+        with open(segments_concat_path, 'w', encoding='utf-8') as f:
+            for seg in self.segments:
+                f.write(f"file '{os.path.basename(self.segments_dir)}/{seg.filename}'\n")
 
-            r = self.execute_shell(f'"{self.config.ffprobe_bin}" -select_streams v -print_format json -show_packets "{self.segments_dir}/{seg.filename}"')
-            packets = json.loads(r.stdout).get('packets')
-            
-            pkt_idx = 0
-            for packet in packets:
-                if packet.get('codec_type') != "video":
-                    continue
-                if packet.get('flags').startswith('K'):
-                    seg.first_keyframe = pkt_idx
-                    break
-                pkt_idx += 1
+        packet_flags = self.stream_shell(f'"{self.config.ffprobe_bin}" -f concat -safe 0 -select_streams v -show_entries packet=flags -print_format compact=p=0:nk=1 "{segments_concat_path}"')
+
+        for pkt_idx, flags in enumerate(packet_flags):
+
+            if not flags.startswith(b'K'):
+                continue
+
+            seg = self.get_segment_at_frame(pkt_idx)
+            if seg is not None and seg.first_keyframe is None:
+                seg.first_keyframe = pkt_idx - seg.frame_range[0]
 
 
     def fetch_jobs(self) -> None:
@@ -491,6 +978,11 @@ class DistrFFmpeg(object):
         slices_dir = os.path.join(self.cur_work_path, "slices_final")
         os.makedirs(slices_dir, exist_ok=True)
         
+        # remote commands of all slices differ only in the selected frame range
+        # so they are parsed once and the range is filled in for every slice
+        # -ss 0.0 fixes bugs in some codecs like vp9 but breaks things
+        remote_cmds = self.get_ffmpeg_commands('ffmpeg -y -f concat -safe 0 -i segments.txt -vf "select=between(n\,REL_STARTFRAME\,REL_ENDFRAME),setpts=N/FRAME_RATE/TB" -fps_mode passthrough -frame_pts true -an -g 10000 out.mkv', ffmpeg_parser.ArgScope.REMOTE)
+
         cur_frame_idx = 0
         slice_idx = 0
 
@@ -529,13 +1021,14 @@ class DistrFFmpeg(object):
             rel_endframe = (last_frame.frame - (required_segments[0].frame_range[0] + required_segments[0].first_keyframe)) - range_correction_frame
 
             #print(f"slice {slice_idx}:", rel_startframe, rel_endframe)
-            # -ss 0.0 fixes bugs in some codecs like vp9 but breaks things
 
-            ffcmds = self.get_ffmpeg_commands(f'ffmpeg -y -f concat -safe 0 -i segments.txt -vf "select=between(n\,{rel_startframe}\,{rel_endframe}),setpts=N/FRAME_RATE/TB" -fps_mode passthrough -frame_pts true -an -g 10000 out.mkv', ffmpeg_parser.ArgScope.REMOTE)
+            ffcmds = [cmd.clone() for cmd in remote_cmds]
+            for cmd in ffcmds:
+                cmd.substitute(REL_STARTFRAME=rel_startframe, REL_ENDFRAME=rel_endframe)
 
             output_path = os.path.join(slices_dir, str(slice_idx).zfill(6)+".mkv")
             
-            self.jobs.append(Job(ffcmds, self.segments_dir, required_segments, output_path))
+            self.jobs.append(Job(ffcmds, self.segments_dir, required_segments, output_path, rel_endframe-rel_startframe+1))
             
             if not cur_slice:
                 break
@@ -543,13 +1036,22 @@ class DistrFFmpeg(object):
             cur_frame_idx = cur_split_frame.frame
             slice_idx += 1
 
+        # dispatch longest jobs first so that short ones fill the gaps at the end of encoding
+        # slices are still merged in video order by their output file names
+        self.jobs.sort(key=lambda j: j.frames, reverse=True)
+
+        with self.sched_cv:
+            self.waiting_jobs = collections.deque(self.jobs)
+            self.completed_jobs_count = 0
+
 
     def get_segment_at_frame(self, frame: int) -> Optional[Segment]:
 
-        for seg in self.segments:
-            if frame in seg.frame_range:
-                return seg
-        
+        # all segments span exactly segment_frames frames (see fetch_segments)
+        idx = frame // self.config.segment_frames
+        if 0 <= idx < len(self.segments):
+            return self.segments[idx]
+
         return None
 
 
@@ -1,9 +1,8 @@
-from enum import Enum
-from dataclasses import dataclass
-from typing import Dict, List, Tuple, Optional
+from enum import IntEnum
+from functools import lru_cache
+from typing import Dict, List, Tuple, Optional, FrozenSet
 from pprint import pprint
-from copy import deepcopy
-import shlex
+import re
 
 
 # in the command "ffmpeg -i input.mp4"
@@ -12,14 +11,15 @@ import shlex
 
 
 # selects the encoding stage at which should the specific argument be applied
-class ArgScope(Enum):
+# int enums compare as plain ints
+class ArgScope(IntEnum):
     PRE     = 1
     REMOTE  = 2
     FINAL   = 3
     DISCARD = 4
     UNKNOWN = 5
 
-class ArgPolicy(Enum):
+class ArgPolicy(IntEnum):
     CONCAT   = 1
     MULTIPLE = 2
     FORBID   = 3
@@ -55,34 +55,68 @@ ARG_POLICIES: Dict[ArgPolicy, List[Optional[str]]] = \
 }
 
 # arguments that require quotes when getting the command
-ARG_QUOTES: List[str] = ["filter:v", "vf", "i"]
+ARG_QUOTES: FrozenSet[str] = frozenset(["filter:v", "vf", "i"])
 
 # flags that don't take any arguments'
-ARG_SINGLES: List[str] = ["y", "n", "v", "report", "vn", "an"]
+ARG_SINGLES: FrozenSet[str] = frozenset(["y", "n", "v", "report", "vn", "an"])
+# same flags as they appear on the command line
+ARG_SINGLES_DASHED: FrozenSet[str] = frozenset("-" + s for s in ARG_SINGLES)
+
+# the tables above flipped into lookups by spec
+# a spec can belong to more than one scope (like "i") but only to one policy
+_SPEC_SCOPES: Dict[Optional[str], FrozenSet[ArgScope]] = {
+    spec: frozenset(scope for scope, specs in ARG_SCOPES.items() if spec in specs)
+    for specs in ARG_SCOPES.values() for spec in specs
+}
+_SPEC_POLICY: Dict[Optional[str], ArgPolicy] = {
+    spec: policy for policy, specs in ARG_POLICIES.items() for spec in specs
+}
 
-@dataclass
+# plain slotted class, params are created for every token and every clone
 class Param(object):
-    spec: str
-    value: str
 
+    __slots__ = ("spec", "value")
 
-def is_param_in_scope(p: Param, scope: ArgScope) -> bool:
+    def __init__(self, spec: Optional[str], value: Optional[str]) -> None:
+        self.spec = spec
+        self.value = value
 
-    if scope == ArgScope.UNKNOWN:
-        for specs in ARG_SCOPES.values():
-            if p.spec in specs:
-                return False
-        return True
+    def __repr__(self) -> str:
+        return f"Param(spec={self.spec!r}, value={self.value!r})"
+
+    def __eq__(self, other: object) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (self.spec, self.value) == (other.spec, other.value)
 
-    return p.spec in ARG_SCOPES.get(scope)
+
+# the tables are constant so results never have to be invalidated
+@lru_cache(maxsize=None)
+def _spec_in_scope(spec: Optional[str], scope: ArgScope) -> bool:
+
+    scopes = _SPEC_SCOPES.get(spec)
+
+    # unknown are those which don't belong to any scope
+    if scopes is None:
+        return scope == ArgScope.UNKNOWN
+
+    return scope in scopes
+
+
+def is_param_in_scope(p: Param, scope: ArgScope) -> bool:
+    return _spec_in_scope(p.spec, scope)
 
 
 class FFmpegCommand(object):
 
+    __slots__ = ("params", "scope", "output", "_spec_index", "_placeholders", "_rendered_cache")
 
     params: List[Param]
     scope: ArgScope
     output: Optional[Param]
+    _spec_index: Dict[Optional[str], Param]
+    _placeholders: Dict[Optional[str], List[Param]]
+    _rendered_cache: Dict[bool, str]
 
 
     def __init__(self, ffmpeg_bin: str, scope: ArgScope) -> None:
@@ -91,27 +125,102 @@ class FFmpegCommand(object):
         self.scope = ArgScope.UNKNOWN
         self.output = None
 
-        self.params.append(
+        # side tables kept in sync with params so add_param doesn't need to scan them
+        # first param of every spec and params of every spec whose value is "PLACEHOLDER"
+        self._spec_index = {}
+        self._placeholders = {}
+        # get_command results by without_bin, cleared whenever params change
+        self._rendered_cache = {}
+
+        self._append_param(
             Param(None, ffmpeg_bin)
         )
         self.scope = scope
 
 
+    # cheaper than deepcopy, params are the only mutable state of a command
+    def clone(self) -> "FFmpegCommand":
+
+        cmd = object.__new__(FFmpegCommand)
+        cmd.params = []
+        cmd.scope = self.scope
+        cmd._spec_index = {}
+        cmd._placeholders = {}
+        cmd._rendered_cache = {}
+        cmd.output = None
+
+        for p in self.params:
+            cmd._append_param(Param(p.spec, p.value))
+
+        # output is always kept as the last param
+        if self.output is not None:
+            cmd.output = cmd.params[-1]
+
+        return cmd
+
+
+    def _append_param(self, p: Param) -> None:
+
+        # output is kept at the end so other params go right before it
+        # params without spec are outputs themselves and replace it afterwards
+        if self.output is not None and p.spec is not None:
+            self.params.insert(len(self.params)-1, p)
+        else:
+            self.params.append(p)
+
+        self._index_param(p)
+
+
+    def _index_param(self, p: Param) -> None:
+
+        self._spec_index.setdefault(p.spec, p)
+
+        # TODO: add an option to skip placeholder replacement in templates
+        if p.value == "PLACEHOLDER":
+            self._placeholders.setdefault(p.spec, []).append(p)
+
+
+    # replaces every occurrence of given tokens in values of all params
+    # lets a parsed command be used as a template e.g.:
+    # cmd.substitute(START=0, END=100) on -vf "select=between(n\,START\,END)"
+    def substitute(self, **tokens: object) -> None:
+
+        self._rendered_cache.clear()
+
+        for p in self.params:
+            if p.value is None:
+                continue
+            was_placeholder = p.value == "PLACEHOLDER"
+            for token, value in tokens.items():
+                if token in p.value:
+                    p.value = p.value.replace(token, str(value))
+
+            # filled placeholders must not be filled again by add_param
+            if was_placeholder and p.value != "PLACEHOLDER":
+                self._placeholders[p.spec].remove(p)
+
+
     def validate(self) -> bool:
 
         # the minimum valid command line would be like:
         # ffmpeg -i input.mp4 output.mp4
-        if len(self.params) < 3:
+        params = self.params
+        if len(params) < 3:
             return False
 
         # the last parameter is the output file
-        if self.params[-1].spec is not None:
+        if params[-1].spec is not None:
             return False
 
+        # local aliases save attribute lookups in the loop
+        scope = self.scope
+        unknown = ArgScope.UNKNOWN
+
         _nospec_opt_cnt = 0
-        for p in self.params:
+        for p in params:
 
-            if not self.validate_param_scope(p):
+            # params must either belong to this scope or be unknown
+            if not (_spec_in_scope(p.spec, scope) or _spec_in_scope(p.spec, unknown)):
                 return False
 
             if p.spec is None:
@@ -121,167 +230,215 @@ class FFmpegCommand(object):
         return _nospec_opt_cnt == 2
 
 
-    def validate_param_scope(self, p: Param) -> bool:
-
-        if not (is_param_in_scope(p, self.scope) or is_param_in_scope(p, ArgScope.UNKNOWN)):
-            return False
-        return True
-
-
     def add_param(self, p: Param, skip_scope: bool=False) -> None:
 
-        if not self.validate_param_scope(p) and not skip_scope:
+        if not skip_scope and not (_spec_in_scope(p.spec, self.scope) or _spec_in_scope(p.spec, ArgScope.UNKNOWN)):
             raise Exception("Invalid scope.")
 
-        i = 0
-        spec_encoutered_i = -1
-        placeholders_idx = []
-
-        while i < len(self.params):
+        self._rendered_cache.clear()
 
-            _p = self.params[i]
-
-            if p.spec == _p.spec and spec_encoutered_i == -1:
-                # found the same spec in command as current one
-                spec_encoutered_i = i
-
-            # TODO: add an option to skip placeholder replacement in templates
-            if _p.value == "PLACEHOLDER":
-                placeholders_idx.append(i)
-
-            i += 1
-
-        # restore i as this where the same spec value was seen
-        i = spec_encoutered_i
-        #print('encountered', p, i, placeholders_idx)
+        # first param in command with the same spec as current one
+        spec_encountered = self._spec_index.get(p.spec)
 
         # if the same spec was found
-        if i != -1:
+        if spec_encountered is not None:
 
             # dealing with PLACEHOLDERs
-            # iterate over found specs whose values are "PLACEHOLDER"
-            for pidx in placeholders_idx:
-                if p.spec == self.params[pidx].spec:
-                    self.params[pidx].value = p.value
-                    break
+            # fill the first param of this spec whose value is "PLACEHOLDER"
+            # it stays a placeholder when filled with "PLACEHOLDER" again
+            placeholders = self._placeholders.get(p.spec)
+            if placeholders:
+                placeholders[0].value = p.value
+                if p.value != "PLACEHOLDER":
+                    placeholders.pop(0)
             else:
+                policy = _SPEC_POLICY.get(p.spec)
+
                 # concat those
-                if p.spec in ARG_POLICIES[ArgPolicy.CONCAT]:
-                    self.params[i].value += f",{p.value}"
+                if policy == ArgPolicy.CONCAT:
+                    spec_encountered.value += f",{p.value}"
                 # those can occur multiple times
-                elif p.spec in ARG_POLICIES[ArgPolicy.MULTIPLE]:
-                    self.params.append(p)
+                elif policy == ArgPolicy.MULTIPLE:
+                    self._append_param(p)
                 # replace the value of those
-                elif p.spec in ARG_POLICIES[ArgPolicy.FORBID]:
+                elif policy == ArgPolicy.FORBID:
                     raise Exception("Param is not allowed.")
                 else:
-                    self.params[i].value = p.value
+                    spec_encountered.value = p.value
+                    if p.value == "PLACEHOLDER":
+                        self._placeholders.setdefault(p.spec, []).append(spec_encountered)
 
                 if p.spec is None:
                     # there can only be one output
-                    if self.output in self.params:
-                        self.params.remove(self.output)
+                    # the new one was just appended right after the old one
+                    if self.output is not None:
+                        del self.params[-2]
                     self.output = p
         else:
             # if spec doesn't exist in command line yet, just append it
-            self.params.append(p)
+            self._append_param(p)
 
-        # keep output at the end
-        if self.output is not None and self.params[-1] != self.output:
-            self.params.remove(self.output)
-            self.params.append(self.output)
 
 
     def get_command(self, without_bin: bool=False) -> str:
 
-        cmd = ""
+        rendered = self._rendered_cache.get(without_bin)
+        if rendered is not None:
+            return rendered
+
+        parts = []
+        # local alias saves an attribute lookup per param
+        append = parts.append
 
         for p in self.params[(1 if without_bin else 0):]:
             if p.spec is None:
-                cmd += f'"{p.value}" '
+                append(f'"{p.value}"')
             elif p.value is None:
-                cmd += f"-{p.spec} "
+                append(f"-{p.spec}")
             elif p.spec in ARG_QUOTES:
-                cmd += f"-{p.spec} \"{p.value}\" "
+                append(f"-{p.spec} \"{p.value}\"")
             else:
-                cmd += f"-{p.spec} {p.value} "
+                append(f"-{p.spec} {p.value}")
 
-        return cmd
+        # every part is followed by a space, including the last one
+        rendered = " ".join(parts) + " " if parts else ""
+        self._rendered_cache[without_bin] = rendered
+        return rendered
 
 
 
-class Parser(object):
+# splits command lines the same way as shlex.split(posix=True)
+# single quotes are literal, inside double quotes backslash only escapes " and \
+# and adjacent quoted pieces like 'a'"b"c form a single token
+# lone quotes and backslashes are only matched when a token can't be, so they mark errors
+_CMD_TOKEN_RE = re.compile(
+    r"""(?:'[^']*'|"(?:[^"\\]|\\.)*"|\\.|[^ \t\r\n'"\\]+(?![^ \t\r\n'"\\]))+|['"\\]""",
+    re.DOTALL
+)
+_CMD_TOKEN_ERRORS: FrozenSet[str] = frozenset(["'", '"', "\\"])
+_CMD_QUOTED_RE = re.compile(r"""'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)""", re.DOTALL)
+_CMD_DQUOTE_ESCAPE_RE = re.compile(r'\\(["\\])')
 
-    scope: ArgScope
-    cmds: List[FFmpegCommand]
 
-    def __init__(self, scope: ArgScope) -> None:
+def _unquote_piece(m: "re.Match[str]") -> str:
 
-        self.scope = scope
-        self.cmds = [FFmpegCommand("ffmpeg", scope)]
-        self._cmd_template = deepcopy(self.cmds[0])
+    single, double, escaped = m.groups()
+    if single is not None:
+        return single
+    if double is not None:
+        return _CMD_DQUOTE_ESCAPE_RE.sub(r"\1", double)
+    return escaped
 
-    def parse_command(self, command_line: str, template: bool=False) -> None:
 
-        ## posix=False means that for example the string:
-        ## '-vf "scale=..."' will be interpreted as
-        ## ["-vf", '"scale=..."'] preserving the quotes
-        splitted_cmdline = shlex.split(command_line, posix=True)
+def _split_ffmpeg_cmd(command_line: str) -> List[str]:
 
-        # distrffmpeg splits remote commands by using ffmpeg keyword
-        # we need to know which one is the last remote command
-        # because only from the last remote command are applied to everything
-        last_remote_idx = splitted_cmdline[1:].count("ffmpeg")
+    tokens = _CMD_TOKEN_RE.findall(command_line)
 
-        i = 1
-        while i < len(splitted_cmdline):
+    if not _CMD_TOKEN_ERRORS.isdisjoint(tokens):
+        raise ValueError("No closing quotation or escaped character.")
 
-            # TODO: check if it works properly
-            is_last_remote = (last_remote_idx+1 == len(self.cmds))
+    # most tokens are plain and don't need any unquoting
+    return [
+        _CMD_QUOTED_RE.sub(_unquote_piece, token)
+        if ("'" in token or '"' in token or "\\" in token) else token
+        for token in tokens
+    ]
 
-            while i < len(splitted_cmdline):
 
-                token = splitted_cmdline[i]
+# turns command line tokens into params before any command is built
+# params are grouped by command, a new one starts at every ffmpeg keyword
+def _tokens_to_params(tokens: List[str]) -> List[List[Param]]:
 
-                if token.startswith("-") and not token == "-":
+    params: List[Param] = []
+    segments = [params]
+    tokens_it = iter(tokens)
 
-                    value = None
-                    if token[1:] not in ARG_SINGLES:
-                        value = splitted_cmdline[i+1]
-                        i += 1
+    for token in tokens_it:
 
-                    p = Param(token[1:], value)
+        if token.startswith("-") and not token == "-":
 
-                # start new command
-                # only applies to remote scope
-                elif token == "ffmpeg":
+            value = None
+            if token not in ARG_SINGLES_DASHED:
+                value = next(tokens_it, None)
+                if value is None:
+                    raise Exception(f"Missing argument for flag {token}.")
 
-                    self.cmds.append(
-                        deepcopy(self._cmd_template)
-                    )
+            params.append(Param(token[1:], value))
 
-                    i += 1
-                    break
+        elif token == "ffmpeg":
+            params = []
+            segments.append(params)
 
-                # treat any argument without dash at the beginning as output file
-                else:
-                    p = Param(None, token)
+        # treat any argument without dash at the beginning as output file
+        else:
+            params.append(Param(None, token))
 
-                if template:
+    return segments
 
-                    self.cmds[-1].add_param(p, skip_scope=True)
 
-                else:
+# whether a parser of given scope takes params of this spec from a command line
+# params of other scopes and discarded ones are dropped
+# any unclassified flag is treated as remote flag
+@lru_cache(maxsize=None)
+def _spec_accepted(spec: Optional[str], scope: ArgScope) -> bool:
+
+    if _spec_in_scope(spec, scope):
+        return True
+    if _spec_in_scope(spec, ArgScope.DISCARD):
+        return False
+    return _spec_in_scope(spec, ArgScope.UNKNOWN) and scope == ArgScope.REMOTE
+
+
+# empty command every parser starts from, one per binary and scope
+@lru_cache(maxsize=8)
+def _make_template(ffmpeg_bin: str, scope: ArgScope) -> FFmpegCommand:
+    return FFmpegCommand(ffmpeg_bin, scope)
+
+
+class Parser(object):
+
+    scope: ArgScope
+    cmds: List[FFmpegCommand]
+
+    def __init__(self, scope: ArgScope) -> None:
+
+        self.scope = scope
+        # the cached template is shared so it's only ever cloned
+        self._cmd_template = _make_template("ffmpeg", scope)
+        self.cmds = [self._cmd_template.clone()]
+
+    def _apply_param_template(self, cmd: FFmpegCommand, p: Param) -> None:
+        cmd.add_param(p, skip_scope=True)
+
+    def _apply_param_runtime(self, cmd: FFmpegCommand, p: Param) -> None:
+        if _spec_accepted(p.spec, self.scope):
+            cmd.add_param(p)
+
+    def parse_command(self, command_line: str, template: bool=False) -> None:
+
+        ## posix=False means that for example the string:
+        ## '-vf "scale=..."' will be interpreted as
+        ## ["-vf", '"scale=..."'] preserving the quotes
+        ## _split_ffmpeg_cmd behaves like posix=True
+        splitted_cmdline = _split_ffmpeg_cmd(command_line)
+
+        # template params are applied without any scope checks
+        apply = self._apply_param_template if template else self._apply_param_runtime
+
+        # the first token is the program name
+        for i, params in enumerate(_tokens_to_params(splitted_cmdline[1:])):
+
+            # start new command
+            # only applies to remote scope
+            if i > 0:
+                self.cmds.append(
+                    self._cmd_template.clone()
+                )
 
-                    if is_param_in_scope(p, self.scope):
-                        self.cmds[-1].add_param(p)
-                    elif is_param_in_scope(p, ArgScope.DISCARD):
-                        pass
-                    elif is_param_in_scope(p, ArgScope.UNKNOWN) and self.scope == ArgScope.REMOTE:
-                        # treat any unclassified flag as remote flag
-                        self.cmds[-1].add_param(p)
+            cmd = self.cmds[-1]
 
-                i += 1
+            for p in params:
+                apply(cmd, p)
 
         # # this would be the final output file name
         # p = self.cmd_final.params[-1]
@@ -289,7 +446,7 @@ class Parser(object):
         #     p.scope = ArgScope.FINAL
 
         if template:
-            self._cmd_template = deepcopy(self.cmds[-1])
+            self._cmd_template = self.cmds[-1].clone()
 
         #for cmd in self.cmds:
         #    print("cmd", cmd.get_command())